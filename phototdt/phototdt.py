@@ -1,96 +1,147 @@
 """Main module."""
+import os
 import tdt
 import numpy as np
 import pandas as pd
 import datetime
+import concurrent.futures
+import multiprocessing
+import functools
+import collections
+import hashlib
 import scipy.signal
-from scipy.sparse import csc_matrix, eye, diags
-from scipy.sparse.linalg import spsolve
+from scipy.ndimage import uniform_filter1d, convolve1d
+from scipy.linalg import solveh_banded
+from numba import njit, prange
 import warnings
 
-def get_tdt_data(block = None, folder=None, ref_stream="_405A", signal_streams=["_465A"], decimate=True, decimate_factor = 10, remove_start=False, verbose=False):
+def get_tdt_data(block = None, folder=None, ref_stream="_405A", signal_streams=["_465A"], decimate=True, decimate_factor = 10, remove_start=False, verbose=False, ftype="fir", cache=True):
   '''
   get_tdt_data is a function to retrieve the data streams as saved by TDT system
   it uses tdt package and will retrieve the complete duration
   returns a data frame with UTC timestamp, time in seconds, and signal values for each channel
+  when decimate=True, streams are downsampled by decimate_factor with a polyphase FIR filter (scipy.signal.resample_poly),
+  which compensates the filter delay, so values differ slightly from the previous scipy.signal.decimate output
+  ftype="mean" averages blocks of decimate_factor samples instead, which is much faster but only has boxcar anti-aliasing
+  when reading from folder with cache=True, the decoded stores are kept in a sidecar cache (see `_read_tdt_cached()`),
+  which is written as `.phototdt_cache.npz` inside the block folder, use cache=False to leave the folder untouched
+  block can also be the folder of the block, so get_tdt_data(photometry_dir) works
   '''
+  block, folder = _block_or_folder(block, folder)
   assert block is not None or folder is not None, "Provide either block or folder to read the block from using tdt.read_block"
+  assert ftype in ["fir", "mean"], f"ftype must be 'fir' or 'mean', received {ftype}"
   assert len(signal_streams) < 3, f"Can only pass signal_streams as [green_channel_name red_channel_name], received {signal_streams}"
-  # TODO check ref_stream and signal_streams are in place
   
   # Get the channel names to only need what's relevant
-  green_channel = signal_streams[0]
-  channel_names = [ref_stream, green_channel]
-  if len(signal_streams) > 1:
-    red_channel = signal_streams[1]
-    channel_names.append(red_channel)
+  channel_names = [ref_stream] + list(signal_streams)
 
   if block is None:
-    # this is not error free
-    store_names = [channel.replace("_", "") for channel in channel_names]
-    # get the headers
-    headers = tdt.read_block(folder, headers=1)
-    all_names_present = all([name in headers.stores.keys() for name in channel_names])
-    assert all_names_present, f"Some provided channel names are not present in block"
-    # now read the relevant data
-    data = tdt.read_block(folder, store = store_names)    
+    store_names = list(channel_names)
+    if remove_start:
+      # laser on times are needed to remove the start
+      store_names.append("Fi1i")
+    data = _read_tdt_cached(folder, store_names, cache=cache)
   else:
     assert isinstance(block, tdt.StructType), f"Block must be tdt.StructType, {type(block)} was provided"
     data = block
 
   if verbose:
     print(f"Reading data from {folder}")
+
+  missing = [name for name in channel_names if name not in data.streams.keys()]
+  assert not missing, f"Streams {missing} not found in block, available streams are {list(data.streams.keys())}"
  
   # Do some parsing of the entries
-  total_samples = len(data.streams.__getattribute__(ref_stream).data)
-  fs = data.streams.__getattribute__(ref_stream).fs
-  #total_seconds = get_total_duration(data) # this produces some rounding errors in the np.arange() call
-  total_seconds = total_samples/fs
+  total_samples = len(data.streams[ref_stream].data)
+  fs = data.streams[ref_stream].fs
   start_date = data.info.start_date
   end_date = data.info.stop_date
   sampling_interval = 1 / fs
-  
-  green_channel = signal_streams[0]
 
   #####   Analyze data ######
-  data_list = []
-  data_list.append(data.streams.__getattribute__(ref_stream).data)
-  data_list.append(data.streams.__getattribute__(green_channel).data)
-
-  if len(signal_streams) > 1:
-    data_list.append(data.streams.__getattribute__(red_channel).data)
+  # TDT streams are float32, keep them that way to halve memory traffic downstream
+  data_list = [np.asarray(data.streams[name].data, dtype=np.float32) for name in channel_names]
 
   # decimate
   if decimate:
     sampling_interval = sampling_interval * decimate_factor
-    total_samples = np.ceil(total_samples / decimate_factor)
-    for i in range(len(data_list)):
-            data_list[i] = scipy.signal.decimate(data_list[i], decimate_factor, ftype="fir")
+    if ftype == "mean":
+      # streams have the same length, average all of them in one call
+      data_list = list(_block_mean(np.vstack(data_list), decimate_factor))
+    else:
+      # the anti-aliasing FIR is shared across channels and calls
+      fir = _fir_for(decimate_factor)
+      # channels are independent and scipy releases the GIL while filtering
+      with concurrent.futures.ThreadPoolExecutor(max_workers=len(data_list)) as ex:
+        data_list = list(ex.map(lambda x: scipy.signal.resample_poly(x, up=1, down=decimate_factor, window=fir), data_list))
+    # take the length from the decimated reference so time, dates, and channels always agree
+    total_samples = len(data_list[0])
 
   # Create a DataFrame with the data for each channel
   data_dict = {
       # UTC datetime
       "utc_datetime" : pd.date_range(start_date, end_date, periods=total_samples),
-      "time_seconds" : np.arange(0, total_seconds, sampling_interval)
+      # built from the sample index so the length always matches total_samples
+      "time_seconds" : np.arange(total_samples, dtype=np.float64) * sampling_interval
   }
 
   for i in range(len(channel_names)):
       if data_list[i] is not None:
           data_dict[channel_names[i]] = data_list[i]
-  # put them into df
-  df = pd.DataFrame(data_dict)
-  
+
+  remove_before = 0
   if remove_start:
     # this will have the times when each laser was turned on
     laser_on_times = data.scalars.Fi1i.ts
     # remove from the max moment when leds are on plus 5 seconds
-    remove_before = np.ceil(max(laser_on_times) * fs) + 5 * fs
     # we only care about the max here 
     # because we end up removing everything before this
-    df = df.iloc[:remove_before]
+    remove_before = min(int(np.ceil((max(laser_on_times) + 5) / sampling_interval)), total_samples)
+    # slice the arrays before building the DataFrame so the removed samples are never copied
+    data_dict = {key: value[remove_before:] for key, value in data_dict.items()}
+
+  # put them into df, the index starts at 0 so calculate_zdFF's n_remove counts rows
+  # decimated channels are new float32 arrays and go in without another copy,
+  # raw streams still belong to the block so those are copied
+  df = pd.DataFrame(data_dict, copy=not decimate)
+  # keep the (decimated) sampling rate so calculate_zdFF doesn't need to estimate it
+  df.attrs['fs'] = 1 / sampling_interval
   
   return df
 
+@functools.lru_cache(maxsize=16)
+def _fir_for(q):
+  '''
+  Anti-aliasing FIR to decimate by q with resample_poly
+  same taps and cutoff resample_poly would design for each call, in float32 so the streams are not upcast
+  '''
+  fir = scipy.signal.firwin(20 * q + 1, 1.0 / q, window=('kaiser', 5.0)).astype(np.float32)
+  # shared between calls, make sure nobody changes it
+  fir.flags.writeable = False
+  return fir
+
+def _block_or_folder(block, folder):
+  '''
+  Functions reading a block take either a tdt.StructType (block) or its folder,
+  a path passed as block is treated as the folder
+  '''
+  if isinstance(block, (str, os.PathLike)):
+    return None, os.fspath(block)
+  return block, folder
+
+def _block_mean(x, q):
+  '''
+  Downsample x along its last axis by q averaging consecutive blocks of q samples
+  a trailing incomplete block is averaged on its own, so the output has ceil(n / q) samples like resample_poly
+  '''
+  n = x.shape[-1]
+  n_full = (n // q) * q
+  out = x[..., :n_full].reshape(x.shape[:-1] + (-1, q)).mean(axis=-1)
+  if n_full < n:
+    tail = x[..., n_full:].mean(axis=-1, keepdims=True)
+    out = np.concatenate([out, tail], axis=-1).astype(x.dtype, copy=False)
+  return out
+
 def list_epocs(block):
   return block.epocs.keys()
 
@@ -99,14 +150,17 @@ def get_epoc(block, epoc_id, when=None):
   This function handles the return of arrays from block.epocs, where `block=tdt.read_data(session_folder)`
   It is likely better called with the handlers `get_epoc_onset()`, `get_epoc_offset()`, and `get_epoc_data()` 
   '''
-  epocs = list_epocs(block)
-  assert when is not None, f"when must not be None"
+  if when is None:
+    raise ValueError("when must not be None")
   if len(epoc_id) < 4:
     # fill the 4 character spaces with "_" as TDT does by default
     epoc_id = epoc_id.ljust(4, "_")
-  assert epoc_id in epocs, f"epoc_id `{epoc_id}` not in epocs {epocs}"
+  epoc = getattr(block.epocs, epoc_id, None)
+  if epoc is None:
+    # only list the epocs when something went wrong
+    raise KeyError(f"epoc_id `{epoc_id}` not in epocs {list(list_epocs(block))}")
   # TODO: asssert that the only possbile values for when are "onset", "offset", "Full", and something else TDT might have
-  return block.epocs.__getattribute__(epoc_id)[when]
+  return epoc[when]
 
 def get_epoc_onset(block, epoc_id):
   return get_epoc(block, epoc_id, "onset")
@@ -118,27 +172,96 @@ def  get_epoc_data(block, epoc_id):
   return get_epoc(block, epoc_id, "data")
 
 
-def get_cam_timestamps(block=None, folder=None, cam_name="Cam1", verbose=False):
+def get_cam_timestamps(block=None, folder=None, cam_name="Cam1", verbose=False, cache=True):
   '''
   get_cam_timestamps is a function to retrieve timestamps from a camera 
   using the data streams as saved by TDT system.
   it uses tdt package and will retrieve the complete duration
   cam_name: string with the camera name as saved configured in Synapse software
+  cache: when reading from folder, keep the decoded epocs in a sidecar cache written inside the block folder (see `_read_tdt_cached()`)
+  block can also be the folder of the block
   returns the timestamp onset
   '''
+  block, folder = _block_or_folder(block, folder)
   assert block is not None or folder is not None, "Provide either block or folder to read the block from using tdt.read_block"
   if block is None:
     if verbose:
       print(f"Reading data from {folder}")
-    data = tdt.read_block(folder)
+    data = _read_tdt_cached(folder, [cam_name], cache=cache)
     return data.epocs[cam_name].onset
   else:
     return block.epocs[cam_name].onset
 
-from functools import wraps
-import inspect
+_CACHE_FILE = ".phototdt_cache.npz"
+# fields kept in the cache for each type of store
+_CACHE_FIELDS = {"streams": ["data", "fs"],
+                 "epocs": ["onset", "offset", "data"],
+                 "scalars": ["ts", "data"]}
+
+def _block_mtime(folder):
+  # newest modification time of the block files, ignoring the cache itself
+  return max([entry.stat().st_mtime for entry in os.scandir(folder) if entry.name != _CACHE_FILE], default=0.0)
+
+@functools.lru_cache(maxsize=8)
+def _read_headers(folder, block_mtime):
+  # block_mtime is part of the key so headers are read again when the block changes
+  return tdt.read_block(folder, headers=1)
+
+def _read_tdt_cached(folder, stores, cache=True):
+  '''
+  Reads `stores` (named as in the block, e.g. "_405A" or "Cam1") from the TDT block in `folder`.
+  Parsing a block with tdt.read_block is slow, so the decoded stores are saved to `folder/.phototdt_cache.npz`
+  and read back from there in later calls. The cache is discarded when any file of the block is modified,
+  and stores that are not in the cache yet are read from the block and added to it.
+  returns a tdt.StructType with info (start_date, stop_date), streams, epocs, and scalars, like tdt.read_block
+  '''
+  cache_file = os.path.join(folder, _CACHE_FILE)
+  block_mtime = _block_mtime(folder)
+  arrays = {}
+  if cache and os.path.exists(cache_file):
+    with np.load(cache_file) as cached:
+      if cached["block_mtime"] == block_mtime:
+        arrays = {key: cached[key] for key in cached.files}
+  cached_stores = {key.split("/")[1] for key in arrays if key.count("/") == 2}
+  missing = [store for store in stores if store not in cached_stores]
+  if missing:
+    # get the headers
+    headers = _read_headers(folder, block_mtime)
+    all_names_present = all([name in headers.stores.keys() for name in missing])
+    assert all_names_present, f"Some provided store names are not present in block {missing}"
+    # now read the relevant data reusing the headers, tdt reads every store listed in
+    # headers it is given, so pass a copy that only lists the missing ones
+    store_headers = tdt.StructType(headers.items())
+    store_headers.stores = tdt.StructType({name: headers.stores[name] for name in missing})
+    data = tdt.read_block(folder, headers=store_headers)
+    if not cache:
+      return data
+    arrays["block_mtime"] = np.float64(block_mtime)
+    arrays["info/start_date"] = np.datetime64(data.info.start_date)
+    arrays["info/stop_date"] = np.datetime64(data.info.stop_date)
+    for kind, fields in _CACHE_FIELDS.items():
+      for name, store in getattr(data, kind, tdt.StructType()).items():
+        for field in fields:
+          if field in store.keys():
+            arrays[f"{kind}/{name}/{field}"] = np.asarray(store[field])
+    try:
+      np.savez(cache_file, **arrays)
+    except OSError as e:
+      warnings.warn(f"Could not write cache to {cache_file}: {e}")
+  # rebuild the block structure from the flat arrays
+  block = tdt.StructType(info=tdt.StructType(), streams=tdt.StructType(), epocs=tdt.StructType(), scalars=tdt.StructType())
+  block.info.start_date = pd.Timestamp(arrays["info/start_date"][()]).to_pydatetime()
+  block.info.stop_date = pd.Timestamp(arrays["info/stop_date"][()]).to_pydatetime()
+  for key, value in arrays.items():
+    if key.count("/") == 2:
+      kind, name, field = key.split("/")
+      if name not in block[kind].keys():
+        block[kind][name] = tdt.StructType()
+      block[kind][name][field] = value[()] if value.ndim == 0 else value
+  return block
 
 def get_total_duration(block=None, folder=None):
+  block, folder = _block_or_folder(block, folder)
   assert block is not None or folder is not None, "Provide either block or folder to read the block from using tdt.read_block"
   if block is None:
     return tdt.read_block(folder, t1=0, t2=0.1).info.duration.total_seconds()
@@ -146,7 +269,7 @@ def get_total_duration(block=None, folder=None):
     return block.info.duration.total_seconds()
 
 def print_kwargs(func):
-  @wraps(func)
+  @functools.wraps(func)
   def wrapper(*args, **kwargs):
       # Print the function name
       verbose = kwargs.get('verbose', False)
@@ -185,12 +308,13 @@ def print_kwargs(func):
 def calculate_zdFF(photo_data, ref_col, sig_col, **kwargs):
   """
   This function calculates the zdFF (z-dimensional Fractional Fluorescence) value for a given dataframe `photo_data`, removes the first `n_remove` rows, and returns a modified dataframe with the zdFF value added as a new column.
-  The zdFF value is calculated using the `get_zdFF_handler` function, which takes the _405 and _465 columns of the dataframe as input and calls the `get_zdFF` function from the `phototdt` module. If `smooth_win` is not provided, the function tries to estimate the sampling rate and smooths the data over a 1-second window. If `chunk_sec` is not provided, the `get_zdFF_handler` function is called on the entire dataframe. Otherwise, the data is split into chunks based on the value of `chunk_sec` and the `get_zdFF_handler` function is called on each chunk.
+  The zdFF value is calculated by `get_zdFF` from the `ref_col` and `sig_col` columns of the dataframe. If `smooth_win` is not provided, the function tries to estimate the sampling rate and smooths the data over a 1-second window. If `chunk_sec` is not provided, `get_zdFF` is called once on the entire dataframe. Otherwise, the two columns are split into chunks based on the value of `chunk_sec` and `get_zdFF` is called on each chunk (as numpy slices, see `_chunk_zdFF`), optionally in `n_jobs` processes.
   Parameters:
   photo_data (pandas.DataFrame): The input dataframe.
   n_remove (int, optional): The number of rows to remove from the beginning of the dataframe. Default is 5000.
   chunk_sec (int, optional): If calculating the zdFF in chunks, chunk_sec is the seconds used to chunk the data in chunks of chunk_sec seconds (or less for the last chunk). `get_zdFF()` will be called for each chunk independently.
-  smooth_win (int, optional): The smooth window to use when calculating the zdFF value. If not provided, the function will try to estimate the sampling rate and smooth over a 1-second window.
+  smooth_win (int, optional): The smooth window to use when calculating the zdFF value. If not provided, the function will smooth over a 1-second window, estimating the sampling rate from `time_seconds`.
+  n_jobs (int, optional): Number of processes used to calculate the chunks when `chunk_sec` is provided. Default is 1 (no parallel processing), None is the same as 1. Negative values count back from the number of CPUs as in joblib (-1 uses all of them).
   Inputs for airPLS:
   lambd: parameter that can be adjusted by user. The larger lambda is,  
           the smoother the resulting background, z
@@ -208,6 +332,7 @@ def calculate_zdFF(photo_data, ref_col, sig_col, **kwargs):
                     'lambd' : 5e4,
                     'porder' : 1,
                     'itermax' : 50,
+                    'n_jobs' : 1,
                     'verbose' : False}
 
   kwargs = { **defaultKwargs, **kwargs }
@@ -215,39 +340,127 @@ def calculate_zdFF(photo_data, ref_col, sig_col, **kwargs):
   n_remove = kwargs.get('n_remove')
   chunk_sec = kwargs.get('chunk_sec')
   smooth_win = kwargs.get('smooth_win')
-
-  photo_subset = photo_data.loc[n_remove:].copy()
+  n_jobs = kwargs.get('n_jobs')
+  if n_jobs is None:
+    # joblib treats None as a single process
+    n_jobs = 1
+  if n_jobs == 0:
+    raise ValueError("n_jobs must be a positive number of processes or negative to count back from the number of CPUs, received 0")
+  if n_jobs < 0:
+    # os.cpu_count() can be None when the number of CPUs can't be determined
+    n_jobs = max(1, (os.cpu_count() or 1) + 1 + n_jobs)
+
+  # only the channels (and time for chunking) are needed, the other columns are left out
+  # photo_data is never modified, zdFF is attached to a new frame at the end
+  columns = [ref_col, sig_col] if chunk_sec is None else ["time_seconds", ref_col, sig_col]
+  photo_subset = photo_data.loc[n_remove:, columns]
   if smooth_win is None:
-      # try to estimate the sampling rate and smooth one second
       # one second might be too much smoothing!
-      smooth_win = int(1 / photo_subset["time_seconds"].diff().values[-1])
+      smooth_win = _one_second_window(photo_data)
       kwargs['smooth_win'] = smooth_win
+  # photo_subset is the tail of photo_data, so zdFF can be placed by position
+  # the removed rows are zero
+  zdFF = np.zeros(len(photo_data), dtype=np.float64)
+  first_row = len(photo_data) - len(photo_subset)
   if chunk_sec is None:
-      photo_subset["zdFF"] = get_zdFF(photo_subset[ref_col], photo_subset[sig_col], **kwargs)
+      zdFF[first_row:] = get_zdFF(photo_subset[ref_col], photo_subset[sig_col], **kwargs)
   else:
-    # make the cuts in time
-    bins=np.arange(0, np.ceil(photo_subset.time_seconds.max()) + chunk_sec, chunk_sec)
-    photo_subset['win'] = pd.cut(x=photo_subset.time_seconds, 
-                          bins=bins,
-                          include_lowest=True)
-    # make them categorical
-    photo_subset['win_i'] = photo_subset.win.cat.codes
-    # find the break points
-    break_points = np.where(photo_subset.win_i != np.roll(photo_subset.win_i, 1))[0]
-    # delete first one so we don't get an empty dataframe
-    break_points = np.delete(break_points, 0)
+    # make the cuts in time, window i covers (i*chunk_sec, (i+1)*chunk_sec] (the first one includes 0)
+    # time is sorted, so each break point is where a window edge falls, no need to label every row
+    time_seconds = photo_subset["time_seconds"].to_numpy()
+    edges = np.arange(chunk_sec, time_seconds[-1], chunk_sec)
+    break_points = np.searchsorted(time_seconds, edges, side="right")
+    # drop empty windows so we don't get an empty dataframe
+    break_points = np.unique(break_points[(break_points > 0) & (break_points < len(time_seconds))])
     # split into list and apply helper function that calls get_zdFF
-    df_list = np.array_split(photo_subset, break_points)
-    #print([x.shape for x in df_list])
-    df_list = list(map(lambda x: get_zdFF_handler(x, ref_col, sig_col, **kwargs), df_list))
-    # concat data to be ready to merge 
-    photo_subset = pd.concat(df_list)
-
-  final_data =  pd.merge(photo_data, photo_subset["zdFF"], 
-                         how="left", 
-                         left_index=True, right_index=True)
-  # make them zero
-  final_data["zdFF"].fillna(0, inplace=True)
+    starts = np.r_[0, break_points]
+    ends = np.r_[break_points, len(photo_subset)]
+    # time is not needed anymore, chunks are slices (views) of the two channel arrays
+    reference = photo_subset[ref_col].to_numpy()
+    signal = photo_subset[sig_col].to_numpy()
+    ref_chunks = [reference[start:end] for start, end in zip(starts, ends)]
+    sig_chunks = [signal[start:end] for start, end in zip(starts, ends)]
+    handler = functools.partial(_chunk_zdFF, **kwargs)
+    if n_jobs > 1:
+      # chunks are independent, fit them in separate processes
+      # spawn instead of fork, forking after numba started its threads can deadlock
+      with concurrent.futures.ProcessPoolExecutor(max_workers=n_jobs, mp_context=multiprocessing.get_context("spawn")) as ex:
+        results = ex.map(handler, ref_chunks, sig_chunks)
+        # results come back in order, each one is written as soon as it arrives
+        for start, values in zip(starts, results):
+          zdFF[first_row + start:first_row + start + len(values)] = values
+    else:
+      for start, ref_chunk, sig_chunk in zip(starts, ref_chunks, sig_chunks):
+        values = handler(ref_chunk, sig_chunk)
+        zdFF[first_row + start:first_row + start + len(values)] = values
+
+  final_data = photo_data.assign(zdFF=zdFF)
+  return final_data
+
+def _one_second_window(photo_data):
+  '''
+  Number of samples in one second of photo_data, estimating the sampling rate from the last two samples of `time_seconds`
+  `photo_data.attrs['fs']` is only used when it agrees with that estimate (it avoids rounding in the time difference)
+  or when there is no time to estimate from, pandas keeps attrs when slicing so it is stale after downsampling the frame
+  '''
+  fs = photo_data.attrs.get('fs')
+  if "time_seconds" in photo_data and len(photo_data) > 1:
+    time_seconds = photo_data["time_seconds"]
+    estimate = 1 / (time_seconds.iat[-1] - time_seconds.iat[-2])
+    if fs is None or not np.isclose(fs, estimate, rtol=1e-3):
+      fs = estimate
+  return int(fs)
+
+@print_kwargs
+def calculate_zdFF_batch(photo_data_list, ref_col, sig_col, **kwargs):
+  """
+  Calculates zdFF for several recordings (e.g., a cohort of animals), see `calculate_zdFF()`.
+  Recordings that have the same number of rows (after removing `n_remove`) and smoothing window are fitted together with `get_zdFF_batch()`,
+  so smoothing and airPLS run once for the whole group instead of once per recording.
+  Parameters:
+  photo_data_list (list of pandas.DataFrame): The input dataframes, each one as returned by `get_tdt_data()`.
+  ref_col, sig_col, n_remove, smooth_win, and inputs for airPLS: as in `calculate_zdFF()`.
+  chunk_sec (int, optional): If provided, recordings can't be fitted together and `calculate_zdFF()` is called on each of them.
+  Returns:
+  list of pandas.DataFrame: The modified dataframes with the zdFF value added as a new column, in the same order as `photo_data_list`.
+  """
+  # update default values of parameters that are moved to **kwargs
+  defaultKwargs = { 'n_remove': 5000, 
+                    'chunk_sec': None,
+                    'smooth_win': None,
+                    'remove' : 0,
+                    'lambd' : 5e4,
+                    'porder' : 1,
+                    'itermax' : 50,
+                    'verbose' : False}
+
+  kwargs = { **defaultKwargs, **kwargs }
+
+  if kwargs.get('chunk_sec') is not None:
+    return [calculate_zdFF(photo_data, ref_col, sig_col, **kwargs) for photo_data in photo_data_list]
+
+  n_remove = kwargs.get('n_remove')
+  # group recordings that can share a single get_zdFF_batch call
+  groups = {}
+  for i, photo_data in enumerate(photo_data_list):
+    smooth_win = kwargs.get('smooth_win')
+    if smooth_win is None:
+      smooth_win = _one_second_window(photo_data)
+    n_rows = len(photo_data.loc[n_remove:])
+    groups.setdefault((n_rows, smooth_win), []).append(i)
+
+  final_data = [None] * len(photo_data_list)
+  for (n_rows, smooth_win), recordings in groups.items():
+    subsets = [photo_data_list[i].loc[n_remove:] for i in recordings]
+    references = np.column_stack([subset[ref_col].to_numpy() for subset in subsets])
+    signals = np.column_stack([subset[sig_col].to_numpy() for subset in subsets])
+    zdFF = get_zdFF_batch(references, signals, **{ **kwargs, 'smooth_win': smooth_win })
+    for j, i in enumerate(recordings):
+      photo_data = photo_data_list[i]
+      # as in calculate_zdFF(), the removed rows are zero
+      column = np.zeros(len(photo_data), dtype=np.float64)
+      column[len(photo_data) - n_rows:] = zdFF[:, j]
+      final_data[i] = photo_data.assign(zdFF=column)
   return final_data
 
 '''
@@ -263,20 +476,11 @@ Reference:
       https://www.jove.com/video/60278/multi-fiber-photometry-to-record-neural-activity-freely-moving
 
 '''
-@print_kwargs
-def get_zdFF_handler(df, ref_col, sig_col, **kwargs):
-  """
-  This function calculates the zdFF (z-dimensional Fractional Fluorescence) value for a given dataframe `df` and returns a modified dataframe with the zdFF value added as a new column.
-  
-  The zdFF value is calculated using the `get_zdFF` function from the `phototdt` module, which takes the _405 and _465 columns of the dataframe as input. If the number of rows in the dataframe is less than the specified `smooth_win` (default is 10), a warning is issued and the `get_zdFF` function is called with a smooth_win value of 10. Otherwise, the `get_zdFF` function is called with a smooth_win value of 10.
-  
-  Parameters:
-  df (pandas.DataFrame): The input dataframe.
-  smooth_win (int, optional): The smooth window to use when calculating the zdFF value. Default is 10.
-  
-  Returns:
-  pandas.DataFrame: The modified dataframe with the zdFF value added as a new column.
-  """
+def _chunk_zdFF(reference, signal, **kwargs):
+  '''
+  zdFF values of one chunk from its reference and signal arrays, see `get_zdFF_handler()`
+  workers only receive and send back arrays instead of DataFrames
+  '''
   # update default values of parameters that are moved to **kwargs
   defaultKwargs = { 'n_remove': 5000, 
                     'chunk_sec': None,
@@ -284,21 +488,36 @@ def get_zdFF_handler(df, ref_col, sig_col, **kwargs):
                     'remove' : 0,
                     'lambd' : 5e4,
                     'porder' : 1,
-                    'itermax' : 50}
+                    'itermax' : 50,
+                    'alpha' : 0.0001}
   kwargs = { **defaultKwargs, **kwargs }
   smooth_win = kwargs.get('smooth_win')
 
   # we should not be removing here 
   kwargs['remove'] = 0
   # check shape
-  df_rows = df.shape[0]
+  n_rows = len(reference)
   # The last chunk will not be smoothed with the same window
-  if df_rows < smooth_win:
-      warnings.warn(f"Provided data has less rows ({df_rows}) than smoothing window ({smooth_win}), using default smooth_win=10")
+  if n_rows < smooth_win:
+      warnings.warn(f"Provided data has less rows ({n_rows}) than smoothing window ({smooth_win}), using default smooth_win=10")
       kwargs['smooth_win'] = 10
-      df['zdFF'] = get_zdFF(df[ref_col], df[sig_col], **kwargs)
-  else:
-      df['zdFF'] = get_zdFF(df[ref_col], df[sig_col], **kwargs)
+  return get_zdFF(reference, signal, **kwargs)
+
+@print_kwargs
+def get_zdFF_handler(df, ref_col, sig_col, **kwargs):
+  """
+  This function calculates the zdFF (z-dimensional Fractional Fluorescence) value for a given dataframe `df` and returns a modified dataframe with the zdFF value added as a new column.
+  
+  The zdFF value is calculated using the `get_zdFF` function from the `phototdt` module, which takes the _405 and _465 columns of the dataframe as input. If the number of rows in the dataframe is less than the specified `smooth_win` (default is 10), a warning is issued and the `get_zdFF` function is called with a smooth_win value of 10. Otherwise, the `get_zdFF` function is called with a smooth_win value of 10.
+  
+  Parameters:
+  df (pandas.DataFrame): The input dataframe.
+  smooth_win (int, optional): The smooth window to use when calculating the zdFF value. Default is 10.
+  
+  Returns:
+  pandas.DataFrame: The modified dataframe with the zdFF value added as a new column.
+  """
+  df['zdFF'] = _chunk_zdFF(df[ref_col].to_numpy(), df[sig_col].to_numpy(), **kwargs)
   return(df)
 
 @print_kwargs
@@ -318,12 +537,10 @@ def get_zdFF(reference, signal, **kwargs):
               the smoother the resulting background, z
       porder: adaptive iteratively reweighted penalized least squares for baseline fitting
       itermax: maximum iteration times
+      alpha: L1 penalty of the non-negative fit of reference to signal (same as sklearn's Lasso alpha), float
   Output
       zdFF - z-score dF/F, 1D numpy array
   '''
-  
-  import numpy as np
-  from sklearn.linear_model import Lasso
 
   # update default values of parameters that are moved to **kwargs
   defaultKwargs = { 'n_remove': 5000, 
@@ -332,7 +549,8 @@ def get_zdFF(reference, signal, **kwargs):
                     'remove' : 0,
                     'lambd' : 5e4,
                     'porder' : 1,
-                    'itermax' : 50}
+                    'itermax' : 50,
+                    'alpha' : 0.0001}
   kwargs = { **defaultKwargs, **kwargs }
 
   smooth_win = kwargs.get('smooth_win')
@@ -340,37 +558,115 @@ def get_zdFF(reference, signal, **kwargs):
   lambd = kwargs.get('lambd')
   porder = kwargs.get('porder')
   itermax = kwargs.get('itermax')
+  alpha = kwargs.get('alpha')
 
- # Smooth signal
-  reference = smooth_signal(reference, smooth_win)
-  signal = smooth_signal(signal, smooth_win)
+  zdFF = _zdFF_columns(np.reshape(reference, (-1, 1)), np.reshape(signal, (-1, 1)),
+                       smooth_win, remove, lambd, porder, itermax, alpha)[:, 0]
+ 
+  return zdFF
+
+@print_kwargs
+def get_zdFF_batch(references, signals, **kwargs):
+  '''
+  Calculates z-score dF/F for several recordings of the same length at once, see `get_zdFF()`
+  All traces are smoothed and baseline corrected together, so the per-call overhead is paid once
+  and the airPLS reweighting runs in parallel over recordings
   
- # Remove slope using airPLS algorithm
-  r_base=airPLS(reference,lambda_=lambd,porder=porder,itermax=itermax)
-  s_base=airPLS(signal,lambda_=lambd,porder=porder,itermax=itermax) 
+  Input
+      references: calcium-independent signals, 2D array with one recording per column (n_samples, n_recordings)
+      signals: calcium-dependent signals, 2D array with the same shape as references
+      smooth_win, remove, lambd, porder, itermax, alpha: as in `get_zdFF()`
+  Output
+      zdFF - z-score dF/F, 2D numpy array with one recording per column
+  '''
+  # update default values of parameters that are moved to **kwargs
+  defaultKwargs = { 'n_remove': 5000, 
+                    'chunk_sec': None,
+                    'smooth_win': None,
+                    'remove' : 0,
+                    'lambd' : 5e4,
+                    'porder' : 1,
+                    'itermax' : 50,
+                    'alpha' : 0.0001}
+  kwargs = { **defaultKwargs, **kwargs }
+
+  references = np.asarray(references)
+  signals = np.asarray(signals)
+  assert references.ndim == 2 and references.shape == signals.shape, f"references and signals must be 2D arrays of the same shape, received {references.shape} and {signals.shape}"
 
- # Remove baseline and the begining of recording
-  reference = (reference[remove:] - r_base[remove:])
-  signal = (signal[remove:] - s_base[remove:])   
+  return _zdFF_columns(references, signals, kwargs.get('smooth_win'), kwargs.get('remove'),
+                       kwargs.get('lambd'), kwargs.get('porder'), kwargs.get('itermax'), kwargs.get('alpha'))
 
- # Standardize signals    
-  reference = (reference - np.median(reference)) / np.std(reference)
-  signal = (signal - np.median(signal)) / np.std(signal)
+def _zdFF_columns(references, signals, smooth_win, remove, lambd, porder, itermax, alpha):
+  '''
+  zdFF for each column pair of references and signals, shared by `get_zdFF()` and `get_zdFF_batch()`
+  '''
+  k = references.shape[1]
+ # Smooth signal, all channels are processed together as columns
+  traces = np.column_stack([references, signals])
+  traces = smooth_signal(traces, smooth_win)
   
- # Align reference signal to calcium signal using non-negative robust linear regression
-  lin = Lasso(alpha=0.0001,precompute=True,max_iter=1000,
-              positive=True, random_state=9999, selection='random')
-  n = len(reference)
-  lin.fit(reference.reshape(n,1), signal.reshape(n,1))
-  reference = lin.predict(reference.reshape(n,1)).reshape(n,)
-
- # z dFF    
-  zdFF = (signal - reference)
- 
-  return zdFF
+ # Remove slope using airPLS algorithm
+  base = airPLS(traces,lambda_=lambd,porder=porder,itermax=itermax)
 
+ # Remove baseline and the begining of recording, and standardize signals
+  zdFF = np.empty((traces.shape[0] - remove, k))
+  for j in range(k):
+    reference = _standardize(traces[:, j], base[:, j], remove)
+    signal = _standardize(traces[:, k + j], base[:, k + j], remove)
+    
+   # Align reference signal to calcium signal using non-negative robust linear regression
+   # with a single feature, the non-negative Lasso (with intercept) has a closed form
+    n = len(reference)
+    ref_mean = reference.mean()
+    sig_mean = signal.mean()
+    reference = reference - ref_mean
+    slope = max(0.0, (np.dot(reference, signal - sig_mean) - alpha * n) / np.dot(reference, reference))
+    reference = slope * reference + sig_mean
+
+   # z dFF    
+    zdFF[:, j] = (signal - reference)
+  return zdFF
 
-def smooth_signal(x,window_len=11,window='flat'):
+@njit(cache=True)
+def _standardize(x, base, start):
+  '''
+  Remove the baseline from x[start:] and standardize it as (y - median(y)) / std(y)
+  The difference is written to a single buffer while std is accumulated (Welford),
+  the median comes from a partial sort (np.partition) instead of a full sort
+  '''
+  n = x.shape[0] - start
+  y = np.empty(n)
+  mean = 0.0
+  m2 = 0.0
+  for j in range(n):
+    y[j] = x[start + j] - base[start + j]
+    delta = y[j] - mean
+    mean += delta / (j + 1)
+    m2 += delta * (y[j] - mean)
+  std = np.sqrt(m2 / n)
+  half = n // 2
+  part = np.partition(y, half)
+  median = part[half]
+  if n % 2 == 0:
+    # lower middle value is the largest one before half after partitioning
+    median = (median + np.max(part[:half])) / 2
+  # multiply by the reciprocal, a division per sample is much slower
+  scale = 1.0 / std
+  for j in range(n):
+    y[j] = (y[j] - median) * scale
+  return y
+
+def _as_float(x):
+    # keep float32 and float64 input as is, everything else becomes float64
+    x = np.asarray(x)
+    if x.dtype not in (np.float32, np.float64):
+        x = x.astype(np.float64)
+    return x
+
+_WINDOWS = {'hanning': np.hanning, 'hamming': np.hamming, 'bartlett': np.bartlett, 'blackman': np.blackman}
+
+def smooth_signal(x,window_len=11,window='flat',axis=0):
 
     """smooth the data using a window with requested size.
     
@@ -385,42 +681,43 @@ def smooth_signal(x,window_len=11,window='flat'):
         window_len: the dimension of the smoothing window; should be an odd integer
         window: the type of window from 'flat', 'hanning', 'hamming', 'bartlett', 'blackman'
                 'flat' window will produce a moving average smoothing.
+        axis: the axis of x to smooth along, so several traces can be smoothed at once
 
     output:
         the smoothed signal        
     """
-    
-    import numpy as np
 
-    if x.ndim != 1:
-        raise(ValueError, "smooth_signal only accepts 1 dimension arrays.")
+    x = _as_float(x)
 
-    if x.size < window_len:
-        raise(ValueError, "Input vector needs to be bigger than window size.")
+    if x.shape[axis] < window_len:
+        raise ValueError("Input vector needs to be bigger than window size.")
 
     if window_len<3:
         return x
 
-    if not window in ['flat', 'hanning', 'hamming', 'bartlett', 'blackman']:
-        raise(ValueError, "Window is one of 'flat', 'hanning', 'hamming', 'bartlett', 'blackman'")
-
-    s=np.r_[x[window_len-1:0:-1],x,x[-2:-window_len-1:-1]]
+    if window != 'flat' and window not in _WINDOWS:
+        raise ValueError("Window is one of 'flat', 'hanning', 'hamming', 'bartlett', 'blackman'")
 
     if window == 'flat': # Moving average
-        w=np.ones(window_len,'d')
-    else:
-        w=eval('np.'+window+'(window_len)')
-
-    y=np.convolve(w/w.sum(),s,mode='valid')
-
-    # Adjust for window being odd/even
-    if window_len % 2 == 0:
-      y = y[(window_len//2-1):-(window_len//2)]
-    else:
-      y = y[(window_len//2):-(window_len//2)]
-
-    if len(y) != len(x):
-        raise ValueError("Output vector does not have the same length as input vector.\nYou might want to change `smooth_win`")
+        # O(n) running mean, 'mirror' mode matches the reflected copies of the cookbook recipe
+        return uniform_filter1d(x, size=window_len, axis=axis, mode='mirror')
+
+    w=_WINDOWS[window](window_len)
+    w=(w/w.sum()).astype(x.dtype)
+
+    if window_len > 64:
+        # long windows are cheaper with FFT overlap-add than direct convolution
+        # numpy's 'reflect' padding is the reflected copies of the cookbook recipe
+        pad = [(0, 0)] * x.ndim
+        pad[axis] = (window_len // 2, window_len - 1 - window_len // 2)
+        kernel = np.expand_dims(w, tuple(d for d in range(x.ndim) if d != axis % x.ndim))
+        return scipy.signal.oaconvolve(np.pad(x, pad, mode='reflect'), kernel, mode='valid', axes=axis)
+
+    # convolve1d reflects the signal at both ends without building a padded copy
+    # 'mirror' mode matches the reflected copies of the cookbook recipe,
+    # and even windows are shifted by one sample to keep its alignment
+    origin = -1 if window_len % 2 == 0 else 0
+    y=convolve1d(x, w, axis=axis, mode='mirror', origin=origin)
 
     return y
 
@@ -474,47 +771,180 @@ def WhittakerSmooth(x,w,lambda_,differences=1):
         w: binary masks (value of the mask is zero if a point belongs to peaks and one otherwise)
         lambda_: parameter that can be adjusted by user. The larger lambda is, 
                  the smoother the resulting background
-        differences: integer indicating the order of the difference of penalties
+        differences: integer indicating the order of the difference of penalties,
+                     only first order differences are implemented (as in the sparse version it replaced)
     
     output
         the fitted background vector
     '''
-    X=np.matrix(x)
-    m=X.size
-    i=np.arange(0,m)
-    E=eye(m,format='csc')
-    D=E[1:]-E[:-1] # numpy.diff() does not work with sparse matrix. This is a workaround.
-    W=diags(w,0,shape=(m,m))
-    A=csc_matrix(W+(lambda_*D.T*D))
-    B=csc_matrix(W*X.T)
-    background=spsolve(A,B)
-    return np.array(background)
+    x=np.asarray(x,dtype=float)
+    w=np.asarray(w,dtype=float)
+    ab=_whittaker_penalty_band(x.shape[0],lambda_)
+    ab[1]+=w
+    background=solveh_banded(ab,w*x,lower=False,overwrite_ab=True,overwrite_b=True,check_finite=False)
+    return background
+
+def _whittaker_penalty_band(m,lambda_):
+    '''
+    Upper banded storage of lambda*D'D, with D the first order difference matrix.
+    W + lambda*D'D is symmetric positive definite and tridiagonal, so it can be
+    solved with LAPACK via solveh_banded instead of building sparse matrices
+    '''
+    ab=np.empty((2,m))
+    ab[0,0]=0
+    ab[0,1:]=-lambda_
+    ab[1]=2*lambda_
+    ab[1,[0,-1]]=lambda_
+    return ab
 
 def airPLS(x, lambda_=100, porder=1, itermax=15):
     '''
     Adaptive iteratively reweighted penalized least squares for baseline fitting
     
     input
-        x: input data (i.e. chromatogram of spectrum)
+        x: input data (i.e. chromatogram of spectrum), 1D array or 2D array with one trace per column
         lambda_: parameter that can be adjusted by user. The larger lambda is,
                  the smoother the resulting background, z
         porder: adaptive iteratively reweighted penalized least squares for baseline fitting
     
     output
-        the fitted background vector
+        the fitted background vector, same shape and dtype as x
+
+    float32 input stays float32 in and out, but the solve itself runs in float64:
+    with the lambda_ used for photometry (5e4) single precision pivots lose most of the baseline.
+    Results can be cached by the contents of x and the parameters, which only helps calling it again on the exact same traces
+    (a different n_remove or smooth_win in calculate_zdFF changes the traces). The cache is off by default,
+    set airPLS.cache_size to the number of results to keep in this process (worker processes don't share it),
+    and use airPLS.clear_cache() to release them.
     '''
+    x=_as_float(x)
+    if airPLS.cache_size > 0:
+        key=(hashlib.blake2b(np.ascontiguousarray(x).data, digest_size=16).digest(),
+             x.shape, x.dtype.str, float(lambda_), porder, itermax)
+        if key in _AIRPLS_CACHE:
+            _AIRPLS_CACHE.move_to_end(key)
+            return _AIRPLS_CACHE[key].copy()
     m=x.shape[0]
-    w=np.ones(m)
-    for i in range(1,itermax+1):
-        z=WhittakerSmooth(x,w,lambda_, porder)
-        d=x-z
-        dssn=np.abs(d[d<0].sum())
-        if(dssn<0.001*(abs(x)).sum() or i==itermax):
-            if(i==itermax): print('WARING max iteration reached!')
-            break
-        w[d>=0]=0 # d>0 means that this point is part of a peak, so its weight is set to 0 in order to ignore it
-        w[d<0]=np.exp(i*np.abs(d[d<0])/dssn)
-        w[0]=np.exp(i*(d[d<0]).max()/dssn) 
-        w[-1]=w[0]
-    return z
-
+    X=np.asfortranarray(x.reshape(m,-1))
+    # the whole iteration runs compiled, one column per thread
+    z,converged=_airpls_columns(X,float(lambda_),itermax)
+    if not converged.all(): print('WARING max iteration reached!')
+    z=z.reshape(x.shape).astype(x.dtype, copy=False)
+    if airPLS.cache_size <= 0:
+        return z
+    _AIRPLS_CACHE[key]=z
+    while len(_AIRPLS_CACHE) > airPLS.cache_size:
+        _AIRPLS_CACHE.popitem(last=False)
+    return z.copy()
+
+# least recently used airPLS results, keyed by (hash of x, shape, dtype, lambda_, porder, itermax)
+# off by default, each entry is a full length baseline
+_AIRPLS_CACHE = collections.OrderedDict()
+airPLS.cache_size = 0
+airPLS.clear_cache = _AIRPLS_CACHE.clear
+
+@njit(cache=True, fastmath=True, parallel=True)
+def _airpls_columns(x, lambda_, itermax):
+    '''
+    airPLS iterations for each column of x, columns are independent and run in parallel
+    
+    input
+        x: input data, one trace per column
+        lambda_: smoothness of the background
+        itermax: maximum iteration times
+    
+    output
+        z: the fitted background for each column (float64)
+        converged: whether each column converged before reaching itermax
+    '''
+    m,k=x.shape
+    z=np.empty((m,k))
+    converged=np.zeros(k,dtype=np.bool_)
+    for c in prange(k):
+        xc=x[:,c]
+        w=np.ones(m)
+        zc=np.empty(m)
+        diag=np.empty(m)
+        tol=0.0
+        for j in range(m):
+            tol+=abs(xc[j])
+        tol*=0.001
+        for i in range(1,itermax+1):
+            _whittaker_tridiagonal(xc,w,lambda_,zc,diag)
+            if _airpls_reweight(xc,zc,w,i,tol):
+                converged[c]=True
+                break
+        z[:,c]=zc
+    return z,converged
+
+@njit(cache=True, fastmath=True, boundscheck=False)
+def _whittaker_tridiagonal(x, w, lambda_, z, diag):
+    '''
+    Solves (W + lambda*D'D) z = W x in place, D being the first order difference matrix
+    The system is symmetric positive definite and tridiagonal (off diagonals are -lambda),
+    so an LDL' factorization (Thomas algorithm) solves it in O(m) without building any matrix
+    
+    input
+        x: input data
+        w: weights, the diagonal of W
+        lambda_: smoothness of the background
+        z: output, the fitted background
+        diag: scratch space of the same length as x, holds the pivots of the factorization
+    '''
+    m=x.shape[0]
+    if m==1:
+        z[0]=x[0]
+        return
+    # forward elimination, z holds the intermediate solution
+    diag[0]=w[0]+lambda_
+    z[0]=w[0]*x[0]
+    for j in range(1,m):
+        a=w[j]+(lambda_ if j==m-1 else 2*lambda_)
+        l=-lambda_/diag[j-1]
+        diag[j]=a+l*lambda_
+        z[j]=w[j]*x[j]-l*z[j-1]
+    # back substitution
+    z[m-1]=z[m-1]/diag[m-1]
+    for j in range(m-2,-1,-1):
+        z[j]=(z[j]+lambda_*z[j+1])/diag[j]
+
+@njit(cache=True, fastmath=True, boundscheck=False)
+def _airpls_reweight(x, z, w, i, tol):
+    '''
+    Fused airPLS convergence test and reweighting step
+    dssn, the absolute sum of the negative residuals d = x - z, is accumulated in the same pass
+    that finds the largest negative residual, and a second pass writes the new weights in place
+    
+    input
+        x: input data
+        z: fitted background of the current iteration
+        w: weights, overwritten with the weights for the next iteration
+        i: current iteration
+        tol: convergence threshold
+    
+    output
+        True if dssn fell below tol, in which case w is left untouched
+    '''
+    m=x.shape[0]
+    dssn=0.0
+    neg_max=0.0
+    found=False
+    for j in range(m):
+        dj=x[j]-z[j]
+        if dj<0:
+            dssn-=dj
+            if not found or dj>neg_max:
+                neg_max=dj
+                found=True
+    if dssn<tol:
+        return True
+    for j in range(m):
+        dj=x[j]-z[j]
+        # d>0 means that this point is part of a peak, so its weight is set to 0 in order to ignore it
+        if dj<0:
+            w[j]=np.exp(-i*dj/dssn)
+        else:
+            w[j]=0.0
+    w[0]=np.exp(i*neg_max/dssn)
+    w[m-1]=w[0]
+    return False
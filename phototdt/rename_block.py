@@ -2,7 +2,12 @@ import os
 import re
 import yaml
 from datetime import datetime
+import functools
 import warnings
+from phototdt.phototdt import _CACHE_FILE
+
+# experiment_name-YYMMDD-HHMMSS_ID-YYMMDD-HHMMSS-suffix
+_BLOCK_RE = re.compile(r"^(.+?)-(\d{6})-(\d{6})_(.+?)-(\d{6})-(\d{6})(.*?)(\.\w+)$")
 
 def rename_block(block_path):
     """Rename the files in a folder using a BIDS-compliant naming convention.
@@ -33,7 +38,11 @@ def rename_block(block_path):
     # Initialize an empty list to store the patterns and new names for the files
     patterns = []
     new_names = []
-    files_in_dir = os.listdir(block_path)
+    # DirEntry objects already carry the full path of each file
+    # the phototdt cache is not part of the block, it keeps its name
+    with os.scandir(block_path) as it:
+        entries = [entry for entry in it if entry.name != _CACHE_FILE]
+    files_in_dir = [entry.name for entry in entries]
     previously_renamed = any([file.endswith("tdt_renaming.yaml") for file in files_in_dir])
 
     if previously_renamed:
@@ -43,9 +52,7 @@ def rename_block(block_path):
     # Iterate over the files in the folder
     for file in files_in_dir:
         # Use a regular expression to match the desired pattern in the file name
-        # experiment_name-YYMMDD-HHMMSS_ID-YYMMDD-HHMMSS-suffix
-        pattern = r"^(.+?)-(\d{6})-(\d{6})_(.+?)-(\d{6})-(\d{6})(.*?)(\.\w+)$"
-        match = re.match(pattern, file)
+        match = _BLOCK_RE.match(file)
 
         # If the pattern is found in the file name
         if match:
@@ -98,9 +105,11 @@ def rename_block(block_path):
 
     # Print a verbose output of the renaming operation
     print("Renaming")
-    for original_name, new_name in renaming_dict.items():
-        print(f"Original name: {original_name} -> New name: {new_name}")
-        os.rename(os.path.join(block_path, original_name), os.path.join(block_path, new_name))
+    print("\n".join(f"Original name: {original_name} -> New name: {new_name}"
+                    for original_name, new_name in renaming_dict.items()))
+    # All checks passed, rename everything in one pass
+    for entry, new_name in zip(entries, new_names):
+        os.rename(entry.path, os.path.join(block_path, new_name))
 
     # Save a log of the renaming operation
     renaming_dict['experiment_name'] = experiment_name
@@ -111,6 +120,9 @@ def rename_block(block_path):
     with open(yaml_name, "w") as file:
         yaml.dump(renaming_dict, file)
 
+# all files of a block share identifier, start_date, and start_time,
+# so the dates are only parsed once per block
+@functools.lru_cache(maxsize=256)
 def bids_format(identifier, start_date, start_time=None, suffix=None):
     # Check if b can be coerced to a date
     try:
@@ -119,7 +131,7 @@ def bids_format(identifier, start_date, start_time=None, suffix=None):
         try:
             datetime.strptime(start_date, "%y%m%d")
         except ValueError:
-            raise ValueError("start_date is not in the correct format. Expecting YYMMDD or YYYYMMDD, got {start_date}")
+            raise ValueError(f"start_date is not in the correct format. Expecting YYMMDD or YYYYMMDD, got {start_date}")
     
     if start_time is None and suffix is None:
         return f"sub-{identifier}_ses-{start_date}"
@@ -14,9 +14,15 @@ def tdt_to_csv(folder_path=None):
 		folder_path = filedialog.askdirectory(initialdir = home)
 
 	photo_data = get_tdt_data(folder_path, remove_start=False)
-	photo_data = calculate_zdFF(photo_data)
+	photo_data = calculate_zdFF(photo_data, ref_col="_405A", sig_col="_465A")
 	home = os.path.expanduser('~')
 	filename = filedialog.asksaveasfilename(title="Type filename to save",
-		filetypes = (("csv files","*.csv.gz"),("all files","*.*")),
+		filetypes = (("csv files","*.csv.gz"),("parquet files","*.parquet"),("all files","*.*")),
 		initialdir = folder_path)
-	photo_data.to_csv(filename, index=False)
+	if filename.endswith(".parquet"):
+		# typed columns are much faster to write than formatting every float as text
+		# zdFF doesn't need double precision on disk, time_seconds keeps it
+		photo_data = photo_data.astype({"zdFF": "float32"})
+		photo_data.to_parquet(filename, compression="zstd", index=False)
+	else:
+		photo_data.to_csv(filename, index=False)
@@ -2,7 +2,12 @@
 
 """Tests for `phototdt` package."""
 
+import datetime
+
+import numpy as np
+import pandas as pd
 import pytest
+import tdt
 
 
 from phototdt import phototdt
@@ -22,3 +27,249 @@ def test_content(response):
     """Sample pytest test function with the pytest fixture as an argument."""
     # from bs4 import BeautifulSoup
     # assert 'GitHub' in BeautifulSoup(response.content).title.string
+
+
+def test_whittaker_smooth_matches_dense_solve():
+    """The banded solve matches the dense penalized least squares system."""
+    rng = np.random.default_rng(0)
+    m = 200
+    x = rng.normal(size=m)
+    w = rng.random(m)
+    lambda_ = 100
+    D = np.diff(np.eye(m), axis=0)
+    expected = np.linalg.solve(np.diag(w) + lambda_ * D.T @ D, w * x)
+    z = phototdt.WhittakerSmooth(x, w, lambda_)
+    assert np.allclose(z, expected)
+
+
+@pytest.mark.parametrize("window", ["flat", "hanning"])
+def test_smooth_signal_matches_convolution(window):
+    """Smoothing equals a convolution with the normalized window over the reflected signal."""
+    x = np.random.default_rng(1).normal(size=500)
+    for window_len in [4, 11, 101]:
+        w = np.ones(window_len) if window == "flat" else np.hanning(window_len)
+        s = np.r_[x[window_len-1:0:-1], x, x[-2:-window_len-1:-1]]
+        y = np.convolve(w / w.sum(), s, mode='valid')
+        if window_len % 2 == 0:
+            y = y[(window_len//2-1):-(window_len//2)]
+        else:
+            y = y[(window_len//2):-(window_len//2)]
+        assert np.allclose(phototdt.smooth_signal(x, window_len, window), y)
+
+
+def _make_block(n_samples=10003, fs=1017.25):
+    """Build a minimal in-memory TDT block with two streams."""
+    rng = np.random.default_rng(0)
+    block = tdt.StructType()
+    block.streams = tdt.StructType()
+    for name in ["_405A", "_465A"]:
+        stream = tdt.StructType()
+        stream.data = (rng.normal(size=n_samples) + 100).astype(np.float32)
+        stream.fs = fs
+        block.streams[name] = stream
+    block.info = tdt.StructType()
+    block.info.start_date = datetime.datetime(2022, 10, 5, 10, 0, 0)
+    block.info.stop_date = block.info.start_date + datetime.timedelta(seconds=n_samples / fs)
+    # laser on times, used by remove_start
+    block.scalars = tdt.StructType(Fi1i=tdt.StructType(ts=np.array([1.0, 2.5])))
+    return block
+
+
+@pytest.mark.parametrize("decimate", [True, False])
+def test_get_tdt_data_time_axis_matches_samples(decimate):
+    """time_seconds and utc_datetime have one entry per (decimated) sample."""
+    block = _make_block()
+    df = phototdt.get_tdt_data(block=block, decimate=decimate, decimate_factor=10)
+    expected = int(np.ceil(10003 / 10)) if decimate else 10003
+    assert df.shape[0] == expected
+    assert df["utc_datetime"].shape[0] == df["time_seconds"].shape[0]
+    # no accumulated float step error, sample i is exactly at i * sampling interval
+    sampling_interval = (10 if decimate else 1) / 1017.25
+    assert np.array_equal(df["time_seconds"].to_numpy(), np.arange(expected) * sampling_interval)
+    assert df.attrs["fs"] == pytest.approx(1 / sampling_interval)
+    # TDT streams are float32 and stay that way
+    assert df["_405A"].dtype == np.float32 and df["_465A"].dtype == np.float32
+
+
+def test_calculate_zdFF_after_remove_start_counts_rows():
+    """n_remove counts rows of a get_tdt_data(remove_start=True) frame, not sample labels."""
+    block = _make_block(n_samples=100003)
+    df = phototdt.get_tdt_data(block=block, remove_start=True)
+    # (2.5 s + 5 s) at the decimated rate
+    assert df.shape[0] == 10001 - int(np.ceil(7.5 * 101.725))
+    assert df.index[0] == 0
+    result = phototdt.calculate_zdFF(df, "_405A", "_465A", n_remove=100)
+    assert np.all(result["zdFF"].to_numpy()[:100] == 0)
+    assert np.all(result["zdFF"].to_numpy()[100:] != 0)
+
+
+def test_one_second_window_follows_time_after_downsampling():
+    """attrs['fs'] survives slicing, the window comes from time_seconds when they disagree."""
+    df = pd.DataFrame({"time_seconds": np.arange(1000) / 100})
+    df.attrs["fs"] = 100
+    assert phototdt._one_second_window(df) == 100
+    assert phototdt._one_second_window(df.iloc[::10].reset_index(drop=True)) == 10
+
+
+def test_read_tdt_cached_reads_block_once(tmp_path, monkeypatch):
+    """A second read of the same folder is served from the sidecar cache."""
+    block = _make_block()
+    (tmp_path / "block.tev").write_bytes(b"")
+    calls = []
+
+    def fake_read_block(folder, headers=0, **kwargs):
+        calls.append(headers)
+        if headers == 1:
+            stores = tdt.StructType()
+            for name in block.streams.keys():
+                stores[name] = tdt.StructType(name=name.lstrip("_"))
+            return tdt.StructType(stores=stores)
+        # headers passed in, only the stores they list are read
+        data = tdt.StructType(info=block.info, streams=tdt.StructType())
+        for name in headers.stores.keys():
+            data.streams[name] = block.streams[name]
+        return data
+
+    monkeypatch.setattr(tdt, "read_block", fake_read_block)
+    first = phototdt.get_tdt_data(folder=str(tmp_path))
+    n_calls = len(calls)
+    second = phototdt.get_tdt_data(folder=str(tmp_path))
+    assert len(calls) == n_calls
+    assert first.equals(second)
+    # the folder can also be passed in place of the block
+    third = phototdt.get_tdt_data(tmp_path)
+    assert len(calls) == n_calls
+    assert first.equals(third)
+
+
+def test_get_zdFF_batch_matches_single_recordings():
+    """Each column of the batch equals get_zdFF on that recording alone."""
+    rng = np.random.default_rng(2)
+    t = np.arange(3000) / 100
+    references = np.column_stack([100 + np.exp(-t / (10 + i)) + rng.normal(0, 0.2, t.size) for i in range(3)])
+    signals = 2 * references + rng.normal(0, 0.2, references.shape)
+    batch = phototdt.get_zdFF_batch(references, signals, smooth_win=10)
+    assert batch.shape == references.shape
+    for j in range(references.shape[1]):
+        single = phototdt.get_zdFF(references[:, j], signals[:, j], smooth_win=10)
+        assert np.allclose(batch[:, j], single)
+
+
+def test_zdFF_fit_matches_sklearn_lasso():
+    """The closed-form fit gives the same zdFF as the non-negative Lasso it replaced."""
+    linear_model = pytest.importorskip("sklearn.linear_model")
+    rng = np.random.default_rng(3)
+    t = np.arange(3000) / 100
+    reference = 100 + np.exp(-t / 10) + rng.normal(0, 0.2, t.size)
+    signal = 2 * reference + rng.normal(0, 0.2, t.size)
+    zdFF = phototdt.get_zdFF(reference, signal, smooth_win=10)
+
+    traces = phototdt.smooth_signal(np.column_stack([reference, signal]), 10)
+    traces = traces - phototdt.airPLS(traces, lambda_=5e4, itermax=50)
+    ref = (traces[:, 0] - np.median(traces[:, 0])) / np.std(traces[:, 0])
+    sig = (traces[:, 1] - np.median(traces[:, 1])) / np.std(traces[:, 1])
+    lin = linear_model.Lasso(alpha=0.0001, precompute=True, max_iter=1000,
+                             positive=True, random_state=9999, selection='random')
+    lin.fit(ref.reshape(-1, 1), sig.reshape(-1, 1))
+    expected = sig - lin.predict(ref.reshape(-1, 1)).reshape(-1)
+    assert np.allclose(zdFF, expected, atol=1e-6)
+
+
+def test_airPLS_cache_returns_same_baseline():
+    """A cached airPLS result equals the fresh one and is not shared with the caller."""
+    x = np.random.default_rng(4).normal(size=(2000, 2)) + np.linspace(0, 5, 2000)[:, None]
+    phototdt.airPLS.cache_size = 8
+    try:
+        first = phototdt.airPLS(x, lambda_=1e3)
+        first[:] = 0
+        second = phototdt.airPLS(x, lambda_=1e3)
+        phototdt.airPLS.clear_cache()
+        assert np.array_equal(second, phototdt.airPLS(x, lambda_=1e3))
+        assert not np.array_equal(second, first)
+    finally:
+        phototdt.airPLS.cache_size = 0
+        phototdt.airPLS.clear_cache()
+    # off by default, nothing is kept
+    phototdt.airPLS(x, lambda_=1e3)
+    assert len(phototdt._AIRPLS_CACHE) == 0
+
+
+def test_calculate_zdFF_batch_matches_single_recordings():
+    """Each recording of the batch equals calculate_zdFF on it alone, lengths may differ."""
+    rng = np.random.default_rng(5)
+    photo_data_list = []
+    for n in [3000, 3000, 2500]:
+        t = np.arange(n) / 100
+        reference = 100 + np.exp(-t / 10) + rng.normal(0, 0.2, n)
+        photo_data_list.append(pd.DataFrame({"time_seconds": t, "_405A": reference,
+                                             "_465A": 2 * reference + rng.normal(0, 0.2, n)}))
+    batch = phototdt.calculate_zdFF_batch(photo_data_list, "_405A", "_465A", n_remove=100)
+    for photo_data, result in zip(photo_data_list, batch):
+        single = phototdt.calculate_zdFF(photo_data, "_405A", "_465A", n_remove=100)
+        assert np.allclose(result["zdFF"], single["zdFF"])
+
+
+def test_airPLS_matches_reference_iteration():
+    """The compiled airPLS follows the reference loop, convergence test included."""
+    rng = np.random.default_rng(6)
+    x = np.linspace(0, 3, 800) + rng.normal(0, 0.1, 800)
+    x[300:320] += 5
+    lambda_, itermax = 100, 15
+    w = np.ones(x.shape[0])
+    for i in range(1, itermax + 1):
+        z = phototdt.WhittakerSmooth(x, w, lambda_)
+        d = x - z
+        dssn = np.abs(d[d < 0].sum())
+        if dssn < 0.001 * (abs(x)).sum():
+            break
+        w[d >= 0] = 0
+        w[d < 0] = np.exp(i * np.abs(d[d < 0]) / dssn)
+        w[0] = np.exp(i * (d[d < 0]).max() / dssn)
+        w[-1] = w[0]
+    assert np.allclose(phototdt.airPLS(x, lambda_=lambda_, itermax=itermax), z)
+
+
+def test_calculate_zdFF_chunks_are_fitted_independently():
+    """With chunk_sec, each (i*chunk_sec, (i+1)*chunk_sec] window gets its own get_zdFF."""
+    rng = np.random.default_rng(7)
+    t = np.arange(3000) / 100
+    reference = 100 + np.exp(-t / 10) + rng.normal(0, 0.2, t.size)
+    photo_data = pd.DataFrame({"time_seconds": t, "_405A": reference,
+                               "_465A": 2 * reference + rng.normal(0, 0.2, t.size)})
+    result = phototdt.calculate_zdFF(photo_data, "_405A", "_465A", n_remove=100, chunk_sec=10, smooth_win=10)
+    assert np.all(result["zdFF"].to_numpy()[:100] == 0)
+    for start, end in [(100, 1001), (1001, 2001), (2001, 3000)]:
+        expected = phototdt.get_zdFF(reference[start:end], photo_data["_465A"].to_numpy()[start:end], smooth_win=10)
+        assert np.allclose(result["zdFF"].to_numpy()[start:end], expected)
+
+
+def test_rename_block_keeps_cache_file(tmp_path):
+    """The phototdt cache in the block folder is neither renamed nor breaks the renaming."""
+    pytest.importorskip("yaml")
+    from phototdt.rename_block import rename_block
+    (tmp_path / "exp-230101-101010_M1-230105-120000.tev").write_bytes(b"")
+    (tmp_path / phototdt._CACHE_FILE).write_bytes(b"")
+    rename_block(str(tmp_path))
+    assert sorted(p.name for p in tmp_path.iterdir()) == [
+        phototdt._CACHE_FILE,
+        "sub-M1_ses-230105T120000.tev",
+        "sub-M1_ses-230105T120000_desc-tdt_renaming.yaml",
+    ]
+
+
+def test_calculate_zdFF_rejects_zero_jobs():
+    """n_jobs=0 is an error instead of silently running serially."""
+    t = np.arange(1000) / 100
+    photo_data = pd.DataFrame({"time_seconds": t, "_405A": np.ones(t.size), "_465A": np.ones(t.size)})
+    with pytest.raises(ValueError):
+        phototdt.calculate_zdFF(photo_data, "_405A", "_465A", n_remove=0, chunk_sec=5, n_jobs=0)
+
+
+def test_calculate_zdFF_none_jobs_is_serial():
+    """n_jobs=None runs in a single process, as in joblib."""
+    rng = np.random.default_rng(6)
+    t = np.arange(2000) / 100
+    photo_data = pd.DataFrame({"time_seconds": t, "_405A": 100 + rng.normal(size=t.size), "_465A": 100 + rng.normal(size=t.size)})
+    result = phototdt.calculate_zdFF(photo_data, "_405A", "_465A", n_remove=0, chunk_sec=10, smooth_win=10, n_jobs=None)
+    expected = phototdt.calculate_zdFF(photo_data, "_405A", "_465A", n_remove=0, chunk_sec=10, smooth_win=10, n_jobs=1)
+    assert np.array_equal(result["zdFF"].to_numpy(), expected["zdFF"].to_numpy())